@@ -37,15 +37,16 @@ For the 'Select control: ...' options, use these keys to modify the value:
 import os
 #os.environ["DEPTHAI_LEVEL"] = "debug"
 
-import cv2
-import numpy as np
 import argparse
 import collections
+import functools
+import queue
+import threading
 import time
-from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
-import signal
+import traceback
 
 
 def socket_type_pair(arg):
@@ -108,12 +109,20 @@ args = parser.parse_args()
 # Set timeouts before importing depthai
 os.environ["DEPTHAI_CONNECTION_TIMEOUT"] = str(args.connection_timeout)
 os.environ["DEPTHAI_BOOT_TIMEOUT"] = str(args.boot_timeout)
-import depthai as dai
 
 if len(sys.argv) == 1:
     import cam_test_gui
     cam_test_gui.main()
 
+# Heavy imports are done only now, so that `--help` and argument errors return quickly
+import cv2
+import numpy as np
+import depthai as dai
+
+# Let HighGUI handle window events from its own thread where supported (GTK),
+# the main loop still calls `waitKey` once per pass for the key presses
+cv2.startWindowThread()
+
 cam_list = []
 cam_type_color = {}
 cam_type_tof = {}
@@ -169,8 +178,76 @@ color_res_opts = {
     '48mp': dai.ColorCameraProperties.SensorResolution.THE_48_MP,
 }
 
-def clamp(num, v0, v1):
-    return max(v0, min(num, v1))
+# Values of a pybind11 enum, in declaration order
+@functools.lru_cache(maxsize=None)
+def enum_values(enum_cls):
+    return tuple(item for name, item in vars(enum_cls).items() if name.isupper())
+
+# Numeric controls adjusted with '-'/'+' once selected, by State.control:
+# CameraControl setter, State attribute, min, max, label
+CONTROL_TABLE = {
+    'ae_comp':        ('setAutoExposureCompensation', 'ae_comp', -9, 9, "Auto exposure compensation:"),
+    'brightness':     ('setBrightness', 'brightness', -10, 10, "Brightness:"),
+    'contrast':       ('setContrast', 'contrast', -10, 10, "Contrast:"),
+    'saturation':     ('setSaturation', 'saturation', -10, 10, "Saturation:"),
+    'sharpness':      ('setSharpness', 'sharpness', 0, 4, "Sharpness:"),
+    'luma_denoise':   ('setLumaDenoise', 'luma_denoise', 0, 4, "Luma denoise:"),
+    'chroma_denoise': ('setChromaDenoise', 'chroma_denoise', 0, 4, "Chroma denoise:"),
+}
+
+# Per-stream properties, fixed once the pipeline is built
+StreamMeta = collections.namedtuple('StreamMeta',
+    ['cam_skt', 'sensor', 'is_tof', 'is_color', 'is_raw', 'is_tof_amp'])
+
+# A value stepped up/down within limits by a pair of keys
+class Control:
+    __slots__ = ('val', 'lo', 'hi', 'step')
+
+    def __init__(self, val, lo, hi, step):
+        self.val = val
+        self.lo = lo
+        self.hi = hi
+        self.step = step
+
+    def bump(self, sign):
+        val = self.val + sign * self.step
+        self.val = self.lo if val < self.lo else self.hi if val > self.hi else val
+        return self.val
+
+# Camera settings and app toggles, changed by the key handlers
+class State:
+    def __init__(self):
+        # Manual focus/exposure and IR controls: default, min, max, step
+        self.lensPos = Control(150, 0, 255, 3)
+        self.expTime = Control(20000, 1, 33000, 500)  # us
+        self.sensIso = Control(800, 100, 1600, 50)
+        self.dotIntensity = Control(0, 0, 1200, 100)
+        self.floodIntensity = Control(0, 0, 1500, 100)
+
+        # Index of the last mode sent, the first change selects the first value
+        self.awb_mode = -1
+        self.anti_banding_mode = -1
+        self.effect_mode = -1
+
+        self.ae_comp = 0
+        self.ae_lock = False
+        self.awb_lock = False
+        self.saturation = 0
+        self.contrast = 0
+        self.brightness = 0
+        self.sharpness = 0
+        self.luma_denoise = 0
+        self.chroma_denoise = 0
+        self.control = 'none'
+        self.show = False
+
+        # Not yet sent CameraControl for the selected +/- control, see `queue_ctrl`
+        self.pending_control = None
+        self.pending_ctrl = None
+        self.pending_deadline = None
+
+        self.capture_set = set()
+        self.capture_time = None
 
 # Calculates FPS over a moving window, configurable
 class FPS:
@@ -178,9 +255,9 @@ class FPS:
         self.dq = collections.deque(maxlen=window_size)
         self.fps = 0
 
-    def update(self, timestamp=None):
-        if timestamp == None:
-            timestamp = time.monotonic()
+    def update(self, timestamp=None, _monotonic=time.monotonic):
+        if timestamp is None:
+            timestamp = _monotonic()
         count = len(self.dq)
         if count > 0:
             self.fps = count / (timestamp - self.dq[0])
@@ -282,13 +359,6 @@ for c in cam_list:
 if args.camera_tuning:
     pipeline.setCameraTuningBlobPath(str(args.camera_tuning))
 
-def exit_cleanly(signum, frame):
-    print("Exiting cleanly")
-    cv2.destroyAllWindows()
-    sys.exit(0)
-
-signal.signal(signal.SIGINT, exit_cleanly)
-
 
 # Pipeline is defined, now we can connect to the device
 device = dai.Device.getDeviceByMxId(args.device)
@@ -317,61 +387,46 @@ with dai.Device(*dai_device_args) as device:
     q = {}
     fps_host = {}  # FPS computed based on the time we receive frames in app
     fps_capt = {}  # FPS computed based on capture timestamps from device
+    stream_meta = {}
     for c in streams:
-        q[c] = device.getOutputQueue(name=c, maxSize=4, blocking=False)
+        q[c] = device.getOutputQueue(name=c, maxSize=1, blocking=False)
         # The OpenCV window resize may produce some artifacts
         if args.resizable_windows:
             cv2.namedWindow(c, cv2.WINDOW_NORMAL)
             cv2.resizeWindow(c, (640, 480))
         fps_host[c] = FPS()
         fps_capt[c] = FPS()
-
+        cam_skt = c.split('_')[-1]
+        stream_meta[c] = StreamMeta(cam_skt=cam_skt,
+                                    # Only used to name captures, don't fail on a missing camera
+                                    sensor=cam_name.get(cam_socket_opts[cam_skt].name, 'unknown'),
+                                    is_tof=cam_type_tof[cam_skt],
+                                    is_color=cam_type_color[cam_skt],
+                                    is_raw=c.startswith('raw_'),
+                                    is_tof_amp=c.startswith('tof_amplitude_'))
+
+    # Blocking, as each control message may carry a different setting and none can be
+    # dropped. A slow link only stalls the `sender` thread, not the UI
     controlQueue = device.getInputQueue('control')
-    tofCfgQueue = device.getInputQueue('tofConfig')
-
-    # Manual exposure/focus set step
-    EXP_STEP = 500  # us
-    ISO_STEP = 50
-    LENS_STEP = 3
-    DOT_STEP = 100
-    FLOOD_STEP = 100
-    DOT_MAX = 1200
-    FLOOD_MAX = 1500
-
-    # Defaults and limits for manual focus/exposure controls
-    lensPos = 150
-    lensMin = 0
-    lensMax = 255
-
-    expTime = 20000
-    expMin = 1
-    expMax = 33000
-
-    sensIso = 800
-    sensMin = 100
-    sensMax = 1600
-
-    dotIntensity = 0
-    floodIntensity = 0
-
-    awb_mode = cycle([item for name, item in vars(
-        dai.CameraControl.AutoWhiteBalanceMode).items() if name.isupper()])
-    anti_banding_mode = cycle([item for name, item in vars(
-        dai.CameraControl.AntiBandingMode).items() if name.isupper()])
-    effect_mode = cycle([item for name, item in vars(
-        dai.CameraControl.EffectMode).items() if name.isupper()])
-
-    ae_comp = 0
-    ae_lock = False
-    awb_lock = False
-    saturation = 0
-    contrast = 0
-    brightness = 0
-    sharpness = 0
-    luma_denoise = 0
-    chroma_denoise = 0
-    control = 'none'
-    show = False
+    # The full ToF config is sent each time, so a newer one may overwrite one still
+    # waiting to be sent, instead of piling up behind a slow link
+    tofCfgQueue = device.getInputQueue('tofConfig', maxSize=1, blocking=False)
+
+    AWB_VALUES = enum_values(dai.CameraControl.AutoWhiteBalanceMode)
+    ABM_VALUES = enum_values(dai.CameraControl.AntiBandingMode)
+    EFFECT_VALUES = enum_values(dai.CameraControl.EffectMode)
+
+    # Prebuilt CameraControl for each value of the enum-cycling controls, sent as is
+    CTRL_CACHE = {}
+    for name, values, setter in [
+            ('awb_mode', AWB_VALUES, 'setAutoWhiteBalanceMode'),
+            ('anti_banding_mode', ABM_VALUES, 'setAntiBandingMode'),
+            ('effect_mode', EFFECT_VALUES, 'setEffectMode')]:
+        for val in values:
+            CTRL_CACHE[(name, val)] = ctrl = dai.CameraControl()
+            getattr(ctrl, setter)(val)
+
+    state = State()
 
     jet_custom = cv2.applyColorMap(np.arange(256, dtype=np.uint8), cv2.COLORMAP_JET)
     jet_custom[0] = [0, 0, 0]
@@ -379,255 +434,423 @@ with dai.Device(*dai_device_args) as device:
     print("Cam:", *['     ' + c.ljust(8)
           for c in cam_list], "[host | capture timestamp]")
 
-    capture_list = []
-    while True:
-        for c in streams:
+    needs_newline = False
+
+    # Host side is split in stages, linked by bounded queues:
+    #   reader (one per stream) -> processor -> display/keys (main thread) -> sender
+    # so that a slow imshow/imwrite doesn't stall acquisition. When a consumer
+    # falls behind, the oldest item is dropped and the newest one is kept.
+    # OpenCV HighGUI calls (imshow, waitKey) must stay on the main thread.
+    stop = threading.Event()
+    frames_ready = threading.Event()
+    pkt_q = {c: queue.Queue(maxsize=4) for c in streams}
+    frame_q = {c: queue.Queue(maxsize=1) for c in streams}
+    send_q = queue.Queue()
+
+    def put_latest(dst, item):
+        while True:
             try:
-                pkt = q[c].tryGet()
-            except Exception as e:
-                print(e)
-                exit_cleanly(0, 0)
-            if pkt is not None:
+                dst.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    dst.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get_latest(src):
+        item = None
+        while True:
+            try:
+                item = src.get_nowait()
+            except queue.Empty:
+                return item
+
+    def run_stage(fn, *fn_args):
+        try:
+            fn(*fn_args)
+        except RuntimeError:
+            # Device queues raise RuntimeError once closed, expected when shutting down
+            if not stop.is_set():
+                traceback.print_exc()
+                stop.set()
+        except Exception:
+            traceback.print_exc()
+            stop.set()
+
+    def reader(c):
+        while not stop.is_set():
+            pkt = q[c].get()
+            # Drain to the newest message, keeping preview latency at about one
+            # frame period (same as a GStreamer appsink with `max-buffers=1 drop=true`)
+            while pkt is not None:
                 fps_host[c].update()
                 fps_capt[c].update(pkt.getTimestamp().total_seconds())
-                width, height = pkt.getWidth(), pkt.getHeight()
-                frame = pkt.getCvFrame()
-                cam_skt = c.split('_')[-1]
-                if cam_type_tof[cam_skt] and not (c.startswith('raw_') or c.startswith('tof_amplitude_')):
-                    if args.tof_cm:
-                        # pixels represent `cm`, capped to 255. Value can be checked hovering the mouse
-                        frame = (frame // 10).clip(0, 255).astype(np.uint8)
-                    else:
-                        frame = (frame.view(np.int16).astype(float))
-                        frame = cv2.normalize(frame, frame, alpha=255, beta=0, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
-                        frame = cv2.applyColorMap(frame, jet_custom)
-                if show:
-                    txt = f"[{c:5}, {pkt.getSequenceNum():4}] "
-                    txt += f"Exp: {pkt.getExposureTime().total_seconds()*1000:6.3f} ms, "
-                    txt += f"ISO: {pkt.getSensitivity():4}, "
-                    txt += f"Lens pos: {pkt.getLensPosition():3}, "
-                    txt += f"Color temp: {pkt.getColorTemperature()} K"
-                    if needs_newline:
-                        print()
-                        needs_newline = False
-                    print(txt)
-                capture = c in capture_list
-                if capture:
-                    capture_file_info = ('capture_' + c + '_' + cam_name[cam_socket_opts[cam_skt].name]
-                         + '_' + str(width) + 'x' + str(height)
-                         + '_exp_' + str(int(pkt.getExposureTime().total_seconds()*1e6))
-                         + '_iso_' + str(pkt.getSensitivity())
-                         + '_lens_' + str(pkt.getLensPosition())
-                         + '_' + capture_time
-                         + '_' + str(pkt.getSequenceNum())
-                        )
-                    capture_list.remove(c)
-                    print()
-                if c.startswith('raw_') or c.startswith('tof_amplitude_'):
-                    if capture:
-                        filename = capture_file_info + '_10bit.bw'
-                        print('Saving:', filename)
-                        frame.tofile(filename)
-                    # Full range for display, use bits [15:6] of the 16-bit pixels
-                    type = pkt.getType()
-                    multiplier = 1
-                    if type == dai.ImgFrame.Type.RAW10: multiplier = (1 << (16-10))
-                    if type == dai.ImgFrame.Type.RAW12: multiplier = (1 << (16-4))
-                    frame = frame * multiplier
-                    # Debayer as color for preview/png
-                    if cam_type_color[cam_skt]:
-                        # See this for the ordering, at the end of page:
-                        # https://docs.opencv.org/4.5.1/de/d25/imgproc_color_conversions.html
-                        # TODO add bayer order to ImgFrame getType()
-                        frame = cv2.cvtColor(frame, cv2.COLOR_BayerGB2BGR)
-                else:
-                    # Save YUV too, but only when RAW is also enabled (for tuning purposes)
-                    if capture and args.enable_raw:
-                        payload = pkt.getData()
-                        filename = capture_file_info + '_P420.yuv'
-                        print('Saving:', filename)
-                        payload.tofile(filename)
-                if capture:
-                    filename = capture_file_info + '.png'
-                    print('Saving:', filename)
-                    cv2.imwrite(filename, frame)
-                cv2.imshow(c, frame)
-        print("\rFPS:",
-              *["{:6.2f}|{:6.2f}".format(fps_host[c].get(), fps_capt[c].get()) for c in cam_list],
-              end=' ', flush=True)
-        needs_newline = True
-
-        key = cv2.waitKey(1)
-        if key == ord('q'):
-            break
-        elif key == ord('/'):
-            show = not show
-            # Print empty string as FPS status new-line separator
-            print("" if show else "Printing camera settings: OFF")
-        elif key == ord('c'):
-            capture_list = streams.copy()
-            capture_time = time.strftime('%Y%m%d_%H%M%S')
-        elif key == ord('g') and tof:
-            f_mod = dai.RawToFConfig.DepthParams.TypeFMod.MAX if tofConfig.depthParams.freqModUsed  == dai.RawToFConfig.DepthParams.TypeFMod.MIN else dai.RawToFConfig.DepthParams.TypeFMod.MIN
-            print("ToF toggling f_mod value to:", f_mod)
-            tofConfig.depthParams.freqModUsed = f_mod
-            tofCfgQueue.send(tofConfig)
-        elif key == ord('h') and tof:
-            tofConfig.depthParams.avgPhaseShuffle = not tofConfig.depthParams.avgPhaseShuffle
-            print("ToF toggling avgPhaseShuffle value to:", tofConfig.depthParams.avgPhaseShuffle)
-            tofCfgQueue.send(tofConfig)
-        elif key == ord('t'):
-            print("Autofocus trigger (and disable continuous)")
-            ctrl = dai.CameraControl()
-            ctrl.setAutoFocusMode(dai.CameraControl.AutoFocusMode.AUTO)
-            ctrl.setAutoFocusTrigger()
-            controlQueue.send(ctrl)
-        elif key == ord('f'):
-            print("Autofocus enable, continuous")
-            ctrl = dai.CameraControl()
-            ctrl.setAutoFocusMode(
-                dai.CameraControl.AutoFocusMode.CONTINUOUS_VIDEO)
-            controlQueue.send(ctrl)
-        elif key == ord('e'):
-            print("Autoexposure enable")
-            ctrl = dai.CameraControl()
-            ctrl.setAutoExposureEnable()
-            controlQueue.send(ctrl)
-        elif key in [ord(','), ord('.')]:
-            if key == ord(','):
-                lensPos -= LENS_STEP
-            if key == ord('.'):
-                lensPos += LENS_STEP
-            lensPos = clamp(lensPos, lensMin, lensMax)
-            print("Setting manual focus, lens position: ", lensPos)
-            ctrl = dai.CameraControl()
-            ctrl.setManualFocus(lensPos)
-            controlQueue.send(ctrl)
-        elif key in [ord('i'), ord('o'), ord('k'), ord('l')]:
-            if key == ord('i'):
-                expTime -= EXP_STEP
-            if key == ord('o'):
-                expTime += EXP_STEP
-            if key == ord('k'):
-                sensIso -= ISO_STEP
-            if key == ord('l'):
-                sensIso += ISO_STEP
-            expTime = clamp(expTime, expMin, expMax)
-            sensIso = clamp(sensIso, sensMin, sensMax)
-            print("Setting manual exposure, time: ", expTime, "iso: ", sensIso)
-            ctrl = dai.CameraControl()
-            ctrl.setManualExposure(expTime, sensIso)
-            controlQueue.send(ctrl)
-        elif key == ord('1'):
-            awb_lock = not awb_lock
-            print("Auto white balance lock:", awb_lock)
-            ctrl = dai.CameraControl()
-            ctrl.setAutoWhiteBalanceLock(awb_lock)
-            controlQueue.send(ctrl)
-        elif key == ord('2'):
-            ae_lock = not ae_lock
-            print("Auto exposure lock:", ae_lock)
-            ctrl = dai.CameraControl()
-            ctrl.setAutoExposureLock(ae_lock)
-            controlQueue.send(ctrl)
-        elif key == ord('a'):
-            dotIntensity = dotIntensity - DOT_STEP
-            if dotIntensity < 0:
-                dotIntensity = 0
-            device.setIrLaserDotProjectorBrightness(dotIntensity)
-        elif key == ord('d'):
-            dotIntensity = dotIntensity + DOT_STEP
-            if dotIntensity > DOT_MAX:
-                dotIntensity = DOT_MAX
-            device.setIrLaserDotProjectorBrightness(dotIntensity)
-        elif key == ord('w'):
-            floodIntensity = floodIntensity + FLOOD_STEP
-            if floodIntensity > FLOOD_MAX:
-                floodIntensity = FLOOD_MAX
-            device.setIrFloodLightBrightness(floodIntensity)
-        elif key == ord('s'):
-            floodIntensity = floodIntensity - FLOOD_STEP
-            if floodIntensity < 0:
-                floodIntensity = 0
-            device.setIrFloodLightBrightness(floodIntensity)
-        elif key >= 0 and chr(key) in '34567890[]p':
-            if key == ord('3'):
-                control = 'awb_mode'
-            elif key == ord('4'):
-                control = 'ae_comp'
-            elif key == ord('5'):
-                control = 'anti_banding_mode'
-            elif key == ord('6'):
-                control = 'effect_mode'
-            elif key == ord('7'):
-                control = 'brightness'
-            elif key == ord('8'):
-                control = 'contrast'
-            elif key == ord('9'):
-                control = 'saturation'
-            elif key == ord('0'):
-                control = 'sharpness'
-            elif key == ord('['):
-                control = 'luma_denoise'
-            elif key == ord(']'):
-                control = 'chroma_denoise'
-            elif key == ord('p'):
-                control = 'tof_amplitude_min'
-            print("Selected control:", control)
-        elif key in [ord('-'), ord('_'), ord('+'), ord('=')]:
-            change = 0
-            if key in [ord('-'), ord('_')]:
-                change = -1
-            if key in [ord('+'), ord('=')]:
-                change = 1
-            ctrl = dai.CameraControl()
-            if control == 'none':
-                print("Please select a control first using keys 3..9 0 [ ]")
-            elif control == 'ae_comp':
-                ae_comp = clamp(ae_comp + change, -9, 9)
-                print("Auto exposure compensation:", ae_comp)
-                ctrl.setAutoExposureCompensation(ae_comp)
-            elif control == 'anti_banding_mode':
-                abm = next(anti_banding_mode)
-                print("Anti-banding mode:", abm)
-                ctrl.setAntiBandingMode(abm)
-            elif control == 'awb_mode':
-                awb = next(awb_mode)
-                print("Auto white balance mode:", awb)
-                ctrl.setAutoWhiteBalanceMode(awb)
-            elif control == 'effect_mode':
-                eff = next(effect_mode)
-                print("Effect mode:", eff)
-                ctrl.setEffectMode(eff)
-            elif control == 'brightness':
-                brightness = clamp(brightness + change, -10, 10)
-                print("Brightness:", brightness)
-                ctrl.setBrightness(brightness)
-            elif control == 'contrast':
-                contrast = clamp(contrast + change, -10, 10)
-                print("Contrast:", contrast)
-                ctrl.setContrast(contrast)
-            elif control == 'saturation':
-                saturation = clamp(saturation + change, -10, 10)
-                print("Saturation:", saturation)
-                ctrl.setSaturation(saturation)
-            elif control == 'sharpness':
-                sharpness = clamp(sharpness + change, 0, 4)
-                print("Sharpness:", sharpness)
-                ctrl.setSharpness(sharpness)
-            elif control == 'luma_denoise':
-                luma_denoise = clamp(luma_denoise + change, 0, 4)
-                print("Luma denoise:", luma_denoise)
-                ctrl.setLumaDenoise(luma_denoise)
-            elif control == 'chroma_denoise':
-                chroma_denoise = clamp(chroma_denoise + change, 0, 4)
-                print("Chroma denoise:", chroma_denoise)
-                ctrl.setChromaDenoise(chroma_denoise)
-            elif control == 'tof_amplitude_min' and tof:
-                amp_min = clamp(tofConfig.depthParams.minimumAmplitude + change, 0, 50)
-                print("Setting min amplitude(confidence) to:", amp_min)
-                tofConfig.depthParams.minimumAmplitude = amp_min
-                tofCfgQueue.send(tofConfig)
-            controlQueue.send(ctrl)
+                latest = pkt
+                pkt = q[c].tryGet()
+            put_latest(pkt_q[c], latest)
+            frames_ready.set()
+
+    # Per-stream output buffers reused across frames, reallocated if the frame
+    # shape or type changes. Saves an allocation of the full frame per conversion.
+    # Two buffers per (stream, tag) are used in turn, so the frame just handed to
+    # the display loop (`frame_q` holds one) is not the one written next. On top,
+    # `display_lock` keeps imshow and the processing of the same stream from
+    # overlapping, in case showing a frame takes longer than processing the next one
+    scratch = {}
+    display_lock = {c: threading.Lock() for c in streams}
+
+    def get_scratch(c, tag, shape, dtype):
+        bufs = scratch.get((c, tag))
+        if bufs is None or bufs[0].shape != shape or bufs[0].dtype != dtype:
+            bufs = scratch[(c, tag)] = [np.empty(shape, dtype), np.empty(shape, dtype)]
+        bufs.reverse()
+        return bufs[0]
+
+    # Capture files are written in the background, not to stall the processor
+    writer = ThreadPoolExecutor(max_workers=2)
+
+    def save(filename, write, *write_args):
+        print('Saving:', filename)
+        fut = writer.submit(write, *write_args)
+        fut.add_done_callback(lambda fut: check_saved(fut, filename))
+
+    def check_saved(fut, filename):
+        # `tofile` raises on errors, `cv2.imwrite` returns False instead
+        err = fut.exception()
+        if err is not None or fut.result() is False:
+            print('Saving failed:', filename, err or '')
+
+    CAPTURE_FMT = "capture_{c}_{name}_{w}x{h}_exp_{exp}_iso_{iso}_lens_{lens}_{t}_{seq}"
+
+    def process(c, pkt):
+        global needs_newline
+        width, height = pkt.getWidth(), pkt.getHeight()
+        m = stream_meta[c]
+        if m.is_tof or m.is_raw:
+            # RAW16/ToF frames come as a zero-copy uint16 view, `getCvFrame()` only copies it
+            frame = pkt.getFrame()
+        else:
+            frame = pkt.getCvFrame()
+        if m.is_tof and not (m.is_raw or m.is_tof_amp):
+            if args.tof_cm:
+                # pixels represent `cm`, capped to 255. Value can be checked hovering the mouse
+                # One saturating pass; beta=-0.45 turns the rounding into the floor of `mm // 10`
+                frame = cv2.convertScaleAbs(frame, dst=get_scratch(c, 'u8', frame.shape, np.uint8),
+                                            alpha=0.1, beta=-0.45)
+            else:
+                # Min-max normalize to 8-bit directly from int16, no float copy
+                depth = frame.view(np.int16)
+                mn, mx, _, _ = cv2.minMaxLoc(depth)
+                alpha = 255.0 / (mx - mn) if mx > mn else 0
+                gray = cv2.convertScaleAbs(depth, dst=get_scratch(c, 'u8', depth.shape, np.uint8),
+                                           alpha=alpha, beta=-mn * alpha)
+                frame = cv2.applyColorMap(gray, jet_custom,
+                                          dst=get_scratch(c, 'bgr', depth.shape + (3,), np.uint8))
+        # Nothing pending in the common case, skip the capture work entirely
+        capture = c in state.capture_set
+        show = state.show
+        if show or capture:
+            # Read the metadata once, only if printed or saved
+            seq = pkt.getSequenceNum()
+            exp = pkt.getExposureTime().total_seconds()
+            iso = pkt.getSensitivity()
+            lens = pkt.getLensPosition()
+        if show:
+            txt = f"[{c:5}, {seq:4}] "
+            txt += f"Exp: {exp*1000:6.3f} ms, "
+            txt += f"ISO: {iso:4}, "
+            txt += f"Lens pos: {lens:3}, "
+            txt += f"Color temp: {pkt.getColorTemperature()} K"
+            if needs_newline:
+                print()
+                needs_newline = False
+            print(txt)
+        if capture:
+            capture_file_info = CAPTURE_FMT.format(
+                c=c, name=m.sensor, w=width, h=height, exp=int(exp*1e6),
+                iso=iso, lens=lens, t=state.capture_time, seq=seq)
+            state.capture_set.discard(c)
+            print()
+        if m.is_raw or m.is_tof_amp:
+            if capture:
+                filename = capture_file_info + '_10bit.bw'
+                save(filename, frame.tofile, filename)
+            # Full range for display, use bits [15:6] of the 16-bit pixels
+            type = pkt.getType()
+            multiplier = 1
+            if type == dai.ImgFrame.Type.RAW10: multiplier = (1 << (16-10))
+            if type == dai.ImgFrame.Type.RAW12: multiplier = (1 << (16-4))
+            if multiplier != 1:
+                frame = np.multiply(frame, multiplier,
+                                    out=get_scratch(c, 'raw', frame.shape, frame.dtype))
+            # Debayer as color for preview/png
+            if m.is_color:
+                # See this for the ordering, at the end of page:
+                # https://docs.opencv.org/4.5.1/de/d25/imgproc_color_conversions.html
+                # TODO add bayer order to ImgFrame getType()
+                frame = cv2.cvtColor(frame, cv2.COLOR_BayerGB2BGR,
+                                     dst=get_scratch(c, 'bgr', frame.shape + (3,), frame.dtype))
+        else:
+            # Save YUV too, but only when RAW is also enabled (for tuning purposes)
+            if capture and args.enable_raw:
+                payload = pkt.getData()
+                filename = capture_file_info + '_P420.yuv'
+                save(filename, payload.tofile, filename)
+        if capture:
+            filename = capture_file_info + '.png'
+            # Copy, as `frame` may be a scratch buffer reused by the next frame
+            save(filename, cv2.imwrite, filename, frame.copy())
+        return frame
+
+    def processor():
+        while not stop.is_set():
+            # Clear before scanning, a frame arriving meanwhile sets it again
+            frames_ready.wait(0.1)
+            frames_ready.clear()
+            for c in streams:
+                pkt = get_latest(pkt_q[c])
+                if pkt is not None:
+                    with display_lock[c]:
+                        frame = process(c, pkt)
+                    put_latest(frame_q[c], frame)
+
+    # Control messages are sent from a separate thread, as XLink writes may block
+    def sender():
+        while True:
+            dst, msg = send_q.get()
+            dst.send(msg)
+
+    # Messages from the key handlers are printed by a daemon thread, so that a slow
+    # console doesn't delay handling keys. Handlers send first, then log
+    log_q = queue.Queue()
+
+    def log(*msg):
+        log_q.put(msg)
+
+    def logger():
+        while True:
+            print(*log_q.get())
+
+    # Key handlers, dispatched through KEY_TABLE from the main loop
+    def quit_app(s):
+        stop.set()
+
+    def toggle_show(s):
+        s.show = not s.show
+        # Print empty string as FPS status new-line separator
+        log("" if s.show else "Printing camera settings: OFF")
+
+    def capture_all(s):
+        s.capture_time = time.strftime('%Y%m%d_%H%M%S')
+        s.capture_set = set(streams)
+
+    def toggle_tof_fmod(s):
+        if not tof:
+            return
+        f_mod = dai.RawToFConfig.DepthParams.TypeFMod.MAX if tofConfig.depthParams.freqModUsed  == dai.RawToFConfig.DepthParams.TypeFMod.MIN else dai.RawToFConfig.DepthParams.TypeFMod.MIN
+        tofConfig.depthParams.freqModUsed = f_mod
+        send_q.put((tofCfgQueue, tofConfig))
+        log("ToF toggling f_mod value to:", f_mod)
+
+    def toggle_tof_phase_shuffle(s):
+        if not tof:
+            return
+        tofConfig.depthParams.avgPhaseShuffle = not tofConfig.depthParams.avgPhaseShuffle
+        send_q.put((tofCfgQueue, tofConfig))
+        log("ToF toggling avgPhaseShuffle value to:", tofConfig.depthParams.avgPhaseShuffle)
+
+    def trigger_autofocus(s):
+        ctrl = dai.CameraControl()
+        ctrl.setAutoFocusMode(dai.CameraControl.AutoFocusMode.AUTO)
+        ctrl.setAutoFocusTrigger()
+        send_q.put((controlQueue, ctrl))
+        log("Autofocus trigger (and disable continuous)")
+
+    def enable_autofocus(s):
+        ctrl = dai.CameraControl()
+        ctrl.setAutoFocusMode(
+            dai.CameraControl.AutoFocusMode.CONTINUOUS_VIDEO)
+        send_q.put((controlQueue, ctrl))
+        log("Autofocus enable, continuous")
+
+    def enable_autoexposure(s):
+        ctrl = dai.CameraControl()
+        ctrl.setAutoExposureEnable()
+        send_q.put((controlQueue, ctrl))
+        log("Autoexposure enable")
+
+    def manual_focus(s, sign):
+        s.lensPos.bump(sign)
+        ctrl = dai.CameraControl()
+        ctrl.setManualFocus(s.lensPos.val)
+        send_q.put((controlQueue, ctrl))
+        log("Setting manual focus, lens position: ", s.lensPos.val)
+
+    def manual_exposure(s, exp_sign, iso_sign):
+        s.expTime.bump(exp_sign)
+        s.sensIso.bump(iso_sign)
+        ctrl = dai.CameraControl()
+        ctrl.setManualExposure(s.expTime.val, s.sensIso.val)
+        send_q.put((controlQueue, ctrl))
+        log("Setting manual exposure, time: ", s.expTime.val, "iso: ", s.sensIso.val)
+
+    def toggle_awb_lock(s):
+        s.awb_lock = not s.awb_lock
+        ctrl = dai.CameraControl()
+        ctrl.setAutoWhiteBalanceLock(s.awb_lock)
+        send_q.put((controlQueue, ctrl))
+        log("Auto white balance lock:", s.awb_lock)
+
+    def toggle_ae_lock(s):
+        s.ae_lock = not s.ae_lock
+        ctrl = dai.CameraControl()
+        ctrl.setAutoExposureLock(s.ae_lock)
+        send_q.put((controlQueue, ctrl))
+        log("Auto exposure lock:", s.ae_lock)
+
+    def dot_projector(s, sign):
+        device.setIrLaserDotProjectorBrightness(s.dotIntensity.bump(sign))
+
+    def flood_light(s, sign):
+        device.setIrFloodLightBrightness(s.floodIntensity.bump(sign))
+
+    def select_control(s, name):
+        s.control = name
+        log("Selected control:", s.control)
+
+    # Controls cycling through enum values, by State.control (also the State
+    # attribute holding the index of the current value): values, label
+    ITER_CONTROLS = {
+        'awb_mode':          (AWB_VALUES, "Auto white balance mode:"),
+        'anti_banding_mode': (ABM_VALUES, "Anti-banding mode:"),
+        'effect_mode':       (EFFECT_VALUES, "Effect mode:"),
+    }
+
+    # Repeated changes of the same control within this window (e.g. a held '+')
+    # are merged into a single CameraControl message
+    COALESCE_DELAY = 0.02  # s
+
+    def queue_ctrl(s, name, template=None):
+        # Returns the CameraControl to apply the change to, merged with a pending one.
+        # A prebuilt `template` (from CTRL_CACHE) replaces the pending message instead
+        if s.pending_control != name:
+            flush_ctrl(s)
+            s.pending_control = name
+            s.pending_deadline = time.monotonic() + COALESCE_DELAY
+        if template is not None:
+            s.pending_ctrl = template
+        elif s.pending_ctrl is None:
+            s.pending_ctrl = dai.CameraControl()
+        return s.pending_ctrl
+
+    def flush_ctrl(s):
+        if s.pending_ctrl is not None:
+            send_q.put((controlQueue, s.pending_ctrl))
+        s.pending_control = s.pending_ctrl = s.pending_deadline = None
+
+    def change_control(s, change):
+        entry = CONTROL_TABLE.get(s.control)
+        if entry is not None:
+            setter, attr, lo, hi, label = entry
+            val = getattr(s, attr) + change
+            val = lo if val < lo else hi if val > hi else val
+            setattr(s, attr, val)
+            getattr(queue_ctrl(s, s.control), setter)(val)
+            log(label, val)
+            return
+        entry = ITER_CONTROLS.get(s.control)
+        if entry is not None:
+            values, label = entry
+            idx = (getattr(s, s.control) + 1) % len(values)
+            setattr(s, s.control, idx)
+            val = values[idx]
+            queue_ctrl(s, s.control, CTRL_CACHE[(s.control, val)])
+            log(label, val)
+        elif s.control == 'none':
+            log("Please select a control first using keys 3..9 0 [ ]")
+        elif s.control == 'tof_amplitude_min' and tof:
+            amp_min = tofConfig.depthParams.minimumAmplitude + change
+            amp_min = 0 if amp_min < 0 else 50 if amp_min > 50 else amp_min
+            tofConfig.depthParams.minimumAmplitude = amp_min
+            send_q.put((tofCfgQueue, tofConfig))
+            log("Setting min amplitude(confidence) to:", amp_min)
+
+    # Built once, so the main loop does a single dict lookup per key event
+    KEY_TABLE = {
+        ord('q'): quit_app,
+        ord('/'): toggle_show,
+        ord('c'): capture_all,
+        ord('g'): toggle_tof_fmod,
+        ord('h'): toggle_tof_phase_shuffle,
+        ord('t'): trigger_autofocus,
+        ord('f'): enable_autofocus,
+        ord('e'): enable_autoexposure,
+        ord(','): lambda s: manual_focus(s, -1),
+        ord('.'): lambda s: manual_focus(s, 1),
+        ord('i'): lambda s: manual_exposure(s, -1, 0),
+        ord('o'): lambda s: manual_exposure(s, 1, 0),
+        ord('k'): lambda s: manual_exposure(s, 0, -1),
+        ord('l'): lambda s: manual_exposure(s, 0, 1),
+        ord('1'): toggle_awb_lock,
+        ord('2'): toggle_ae_lock,
+        ord('a'): lambda s: dot_projector(s, -1),
+        ord('d'): lambda s: dot_projector(s, 1),
+        ord('w'): lambda s: flood_light(s, 1),
+        ord('s'): lambda s: flood_light(s, -1),
+        ord('-'): lambda s: change_control(s, -1),
+        ord('_'): lambda s: change_control(s, -1),
+        ord('+'): lambda s: change_control(s, 1),
+        ord('='): lambda s: change_control(s, 1),
+    }
+    for key, name in [('3', 'awb_mode'), ('4', 'ae_comp'), ('5', 'anti_banding_mode'),
+                      ('6', 'effect_mode'), ('7', 'brightness'), ('8', 'contrast'),
+                      ('9', 'saturation'), ('0', 'sharpness'), ('[', 'luma_denoise'),
+                      (']', 'chroma_denoise'), ('p', 'tof_amplitude_min')]:
+        KEY_TABLE[ord(key)] = lambda s, name=name: select_control(s, name)
 
+    for c in streams:
+        threading.Thread(target=run_stage, args=(reader, c), daemon=True).start()
+    processor_thread = threading.Thread(target=run_stage, args=(processor,), daemon=True)
+    processor_thread.start()
+    threading.Thread(target=run_stage, args=(sender,), daemon=True).start()
+    threading.Thread(target=run_stage, args=(logger,), daemon=True).start()
+
+    # The FPS status line is refreshed at most every 100ms, not on every loop pass
+    FPS_FMT = ' '.join(["{:6.2f}|{:6.2f}"] * len(cam_list))
+    next_print = 0.0
+    try:
+        while not stop.is_set():
+            for c in streams:
+                frame = get_latest(frame_q[c])
+                if frame is not None:
+                    with display_lock[c]:
+                        cv2.imshow(c, frame)
+            now = time.monotonic()
+            if now >= next_print:
+                next_print = now + 0.1
+                print("\rFPS:",
+                      FPS_FMT.format(*[f for c in cam_list for f in (fps_host[c].get(), fps_capt[c].get())]),
+                      end=' ', flush=True)
+                needs_newline = True
+
+            # Handle all the keys pressed since the last pass, not just one per frame.
+            # Only waitKey masks the code, pollKey may keep modifier bits (GTK), so
+            # every code is reduced to its low byte before the lookup.
+            key = cv2.waitKey(1)
+            while key != -1:
+                handler = KEY_TABLE.get(key & 0xFF)
+                if handler:
+                    handler(state)
+                key = cv2.pollKey()
+            if state.pending_deadline is not None and time.monotonic() >= state.pending_deadline:
+                flush_ctrl(state)
+    except KeyboardInterrupt:
+        # Ctrl+C goes through the same shutdown as 'q', so pending captures are still saved
+        print("\nExiting cleanly")
+
+    stop.set()
+    # The processor may still be saving a capture, let it finish before closing the writer
+    processor_thread.join()
+    writer.shutdown(wait=True)
     print()